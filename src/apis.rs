@@ -1,11 +1,47 @@
 use anyhow::Context;
 use async_openai::types::{
     ChatCompletionRequestSystemMessageArgs, ChatCompletionRequestUserMessageArgs,
-    CreateChatCompletionRequestArgs,
+    CreateChatCompletionRequestArgs, FinishReason,
 };
-use async_openai::Client as OpenAiClient;
+use async_openai::{config::OpenAIConfig, Client as OpenAiClient};
 use reqwest::{Client, Method};
-use std::env;
+use std::{
+    collections::HashMap,
+    env,
+    sync::{
+        atomic::{AtomicU64, Ordering},
+        LazyLock, Mutex,
+    },
+    time::{Duration, Instant},
+};
+use tokio::sync::Semaphore;
+
+/// Shared http client so connections are pooled and kept alive between requests,
+/// https hosts that support it negotiate http2 and multiplex requests over one connection
+pub static HTTP_CLIENT: LazyLock<Client> = LazyLock::new(|| {
+    Client::builder()
+        .pool_idle_timeout(Duration::from_secs(60))
+        .pool_max_idle_per_host(20)
+        .connect_timeout(Duration::from_secs(10))
+        .http2_adaptive_window(true)
+        .http2_keep_alive_interval(Duration::from_secs(30))
+        .http2_keep_alive_while_idle(true)
+        .build()
+        .expect("Failed to build http client")
+});
+
+/// Shared openai client, built on top of the shared http client
+pub static OPENAI_CLIENT: LazyLock<OpenAiClient<OpenAIConfig>> =
+    LazyLock::new(|| OpenAiClient::new().with_http_client(HTTP_CLIENT.clone()));
+
+/// Limits how many openai requests can be in flight at once
+pub static OPENAI_PERMITS: LazyLock<Semaphore> =
+    LazyLock::new(|| Semaphore::new(MAX_OPENAI_REQUESTS));
+
+/// Most tokens a cleaned user name can take
+const NAME_MAX_TOKENS: u32 = 16;
+/// Most openai requests that can be in flight at once
+const MAX_OPENAI_REQUESTS: usize = 8;
 
 #[derive(Clone)]
 pub enum ArrService {
@@ -21,6 +57,116 @@ impl std::fmt::Display for ArrService {
     }
 }
 
+impl ArrService {
+    /// Read every services credentials from the environment, panicking if any are missing
+    pub fn load_credentials() {
+        LazyLock::force(&SONARR_CREDENTIALS);
+        LazyLock::force(&RADARR_CREDENTIALS);
+    }
+
+    /// Get the services credentials, read from the environment by `load_credentials`
+    fn credentials(&self) -> &'static ArrCredentials {
+        match self {
+            Self::Sonarr => &SONARR_CREDENTIALS,
+            Self::Radarr => &RADARR_CREDENTIALS,
+        }
+    }
+}
+
+/// Connection details for an arr service
+struct ArrCredentials {
+    url: String,
+    api_key: String,
+    username: String,
+    password: String,
+}
+impl ArrCredentials {
+    fn from_env(service: &ArrService) -> Self {
+        let service_name = service.to_string().to_uppercase();
+        Self {
+            url: get_env_variable(&format!("{service_name}_URL")),
+            api_key: get_env_variable(&format!("{service_name}_API")),
+            username: get_env_variable(&format!("{service_name}_AUTHUSER")),
+            password: get_env_variable(&format!("{service_name}_AUTHPASS")),
+        }
+    }
+}
+
+static SONARR_CREDENTIALS: LazyLock<ArrCredentials> =
+    LazyLock::new(|| ArrCredentials::from_env(&ArrService::Sonarr));
+static RADARR_CREDENTIALS: LazyLock<ArrCredentials> =
+    LazyLock::new(|| ArrCredentials::from_env(&ArrService::Radarr));
+
+/// In memory cache where entries expire after a set time
+pub struct TimedCache<V> {
+    ttl: Duration,
+    max_entries: usize,
+    entries: Mutex<HashMap<String, (Instant, V)>>,
+    /// Bumped on every clear, so results fetched before a clear aren't stored after it
+    generation: AtomicU64,
+}
+impl<V: Clone> TimedCache<V> {
+    pub fn new(ttl: Duration, max_entries: usize) -> Self {
+        Self {
+            ttl,
+            max_entries,
+            entries: Mutex::new(HashMap::new()),
+            generation: AtomicU64::new(0),
+        }
+    }
+
+    /// Get a value if it exists and hasn't expired
+    pub fn get(&self, key: &str) -> Option<V> {
+        let entries = self.entries.lock().unwrap();
+        entries
+            .get(key)
+            .filter(|(inserted, _)| inserted.elapsed() < self.ttl)
+            .map(|(_, value)| value.clone())
+    }
+
+    /// The current generation, read before fetching a value to pass to `insert_if_current`
+    pub fn generation(&self) -> u64 {
+        self.generation.load(Ordering::Acquire)
+    }
+
+    /// Insert a value, making room by dropping expired then oldest entries
+    pub fn insert(&self, key: String, value: V) {
+        let mut entries = self.entries.lock().unwrap();
+        self.insert_entry(&mut entries, key, value);
+    }
+
+    /// Insert a value only if the cache hasn't been cleared since `generation` was read
+    pub fn insert_if_current(&self, generation: u64, key: String, value: V) {
+        let mut entries = self.entries.lock().unwrap();
+        if self.generation.load(Ordering::Acquire) == generation {
+            self.insert_entry(&mut entries, key, value);
+        }
+    }
+
+    fn insert_entry(&self, entries: &mut HashMap<String, (Instant, V)>, key: String, value: V) {
+        if entries.len() >= self.max_entries {
+            entries.retain(|_, (inserted, _)| inserted.elapsed() < self.ttl);
+        }
+        if entries.len() >= self.max_entries {
+            let oldest = entries
+                .iter()
+                .min_by_key(|(_, (inserted, _))| *inserted)
+                .map(|(oldest_key, _)| oldest_key.clone());
+            if let Some(oldest) = oldest {
+                entries.remove(&oldest);
+            }
+        }
+        entries.insert(key, (Instant::now(), value));
+    }
+
+    /// Remove all entries
+    pub fn clear(&self) {
+        let mut entries = self.entries.lock().unwrap();
+        self.generation.fetch_add(1, Ordering::AcqRel);
+        entries.clear();
+    }
+}
+
 pub fn get_env_variable(key: &str) -> String {
     match env::var(key) {
         Ok(value) => value,
@@ -36,10 +182,14 @@ pub fn get_env_variable(key: &str) -> String {
 /// Get from the names file the users name if it exists, cleaned up string
 pub async fn user_name_from_id(user_id: &String, user_name_dirty: &str) -> anyhow::Result<String> {
     // Create names.toml file if doesnt exist
-    if !std::path::Path::new("names.toml").exists() {
-        std::fs::File::create("names.toml").context("Failed to create names file")?;
+    if !tokio::fs::try_exists("names.toml").await.unwrap_or(false) {
+        tokio::fs::File::create("names.toml")
+            .await
+            .context("Failed to create names file")?;
     }
-    let contents = std::fs::read_to_string("names.toml").context("Failed to read names file")?;
+    let contents = tokio::fs::read_to_string("names.toml")
+        .await
+        .context("Failed to read names file")?;
     let mut parsed_toml: toml::Value = contents.parse().context("Failed to parse TOML content")?;
 
     // If doesn't have user, add it
@@ -58,22 +208,49 @@ pub async fn user_name_from_id(user_id: &String, user_name_dirty: &str) -> anyho
         if user.as_table().unwrap().contains_key("name") {
             user.get("name").unwrap().as_str().unwrap().to_string()
         } else {
-            // Convert name to plaintext alphanumeric only with gpt
-            let response = gpt_info_query(
-                user_name_dirty.to_string(),
-                "Convert the above name to plaintext alphanumeric only, if it is already alphanumeric just return the name".to_string(),
-            )
-            .await.map_err(|e| anyhow::anyhow!(e)).context("Failed GPT query")?;
+            // Names that are already alphanumeric are used as is, otherwise convert with gpt
+            let name = if !user_name_dirty.is_empty()
+                && user_name_dirty.chars().all(|c| c.is_ascii_alphanumeric())
+            {
+                user_name_dirty.to_string()
+            } else {
+                let (gpt_name, finish_reason) = gpt_query(
+                    user_name_dirty.to_string(),
+                    "Convert the above name to plaintext alphanumeric only, if it is already alphanumeric just return the name".to_string(),
+                    Some(NAME_MAX_TOKENS),
+                )
+                .await.map_err(|e| anyhow::anyhow!(e)).context("Failed GPT query")?;
+                let gpt_name = gpt_name.trim();
+
+                // Don't store a cut off or non alphanumeric answer, strip the name down instead
+                if matches!(finish_reason, Some(FinishReason::Length))
+                    || gpt_name.is_empty()
+                    || !gpt_name.chars().all(|c| c.is_ascii_alphanumeric())
+                {
+                    let stripped_name: String = user_name_dirty
+                        .chars()
+                        .filter(char::is_ascii_alphanumeric)
+                        .collect();
+                    if stripped_name.is_empty() {
+                        user_id.to_string()
+                    } else {
+                        stripped_name
+                    }
+                } else {
+                    gpt_name.to_string()
+                }
+            };
 
             // Write file
-            let name = response;
             let mut user = user.as_table().unwrap().clone();
             user.insert("name".to_string(), toml::Value::String(name.clone()));
             let mut parsed_toml = parsed_toml.as_table().unwrap().clone();
             parsed_toml.insert(user_id.to_string(), toml::Value::Table(user));
             let toml_string =
                 toml::to_string(&parsed_toml).context("Failed to serialize TOML data")?;
-            std::fs::write("names.toml", toml_string).context("Failed to write to names file")?;
+            tokio::fs::write("names.toml", toml_string)
+                .await
+                .context("Failed to write to names file")?;
 
             name
         }
@@ -85,27 +262,43 @@ pub async fn user_name_from_id(user_id: &String, user_name_dirty: &str) -> anyho
 
 /// Use gpt to query information
 pub async fn gpt_info_query(data: String, prompt: String) -> Result<String, String> {
-    let request = CreateChatCompletionRequestArgs::default()
-        .model("gpt-4o")
-        .messages([
-            ChatCompletionRequestSystemMessageArgs::default()
-                .content(data)
-                .build()
-                .unwrap()
-                .into(),
-            ChatCompletionRequestUserMessageArgs::default()
-                .content(prompt)
-                .build()
-                .unwrap()
-                .into(),
-        ])
-        .build()
-        .unwrap();
+    gpt_query(data, prompt, None)
+        .await
+        .map(|(response, _)| response)
+}
+
+/// Use gpt to query information, optionally capping the length of the response,
+/// returns the response and why it finished
+async fn gpt_query(
+    data: String,
+    prompt: String,
+    max_tokens: Option<u32>,
+) -> Result<(String, Option<FinishReason>), String> {
+    let mut request_args = CreateChatCompletionRequestArgs::default();
+    request_args.model("gpt-4o").temperature(0.0).messages([
+        ChatCompletionRequestSystemMessageArgs::default()
+            .content(data)
+            .build()
+            .unwrap()
+            .into(),
+        ChatCompletionRequestUserMessageArgs::default()
+            .content(prompt)
+            .build()
+            .unwrap()
+            .into(),
+    ]);
+    if let Some(max_tokens) = max_tokens {
+        request_args.max_completion_tokens(max_tokens);
+    }
+    let request = request_args.build().unwrap();
 
     // Retry the request if it fails
     let mut tries = 0;
     let response = loop {
-        let response = OpenAiClient::new().chat().create(request.clone()).await;
+        let response = {
+            let _permit = OPENAI_PERMITS.acquire().await.map_err(|e| e.to_string())?;
+            OPENAI_CLIENT.chat().create(request.clone()).await
+        };
         match response {
             Ok(response) => break Ok(response),
             Err(error) => {
@@ -121,16 +314,8 @@ pub async fn gpt_info_query(data: String, prompt: String) -> Result<String, Stri
     if response.is_err() {
         return Err("Failed to get response from openai".to_string());
     }
-    let result = response
-        .unwrap()
-        .choices
-        .first()
-        .unwrap()
-        .message
-        .content
-        .clone()
-        .unwrap();
-    Ok(result)
+    let choice = response.unwrap().choices.into_iter().next().unwrap();
+    Ok((choice.message.content.unwrap(), choice.finish_reason))
 }
 
 /// Make a request to an arr service
@@ -140,23 +325,17 @@ pub async fn arr_request(
     url: String,
     data: Option<String>,
 ) -> anyhow::Result<serde_json::Value> {
-    let temp_service = service.to_string().to_uppercase();
-    let service_name = temp_service.as_str();
-
-    let arr_api_key = get_env_variable(format!("{service_name}_API").as_str());
-    let arr_url = get_env_variable(format!("{service_name}_URL").as_str());
-    let username = get_env_variable(format!("{service_name}_AUTHUSER").as_str());
-    let password = get_env_variable(format!("{service_name}_AUTHPASS").as_str());
+    let credentials = service.credentials();
+    let arr_url = &credentials.url;
+    let arr_api_key = &credentials.api_key;
 
-    let client = Client::builder().build()?;
     let last_sep = if url.contains('?') { "&" } else { "?" };
-    let mut request = client
+    let mut request = HTTP_CLIENT
         .request(
             method,
             format!("{arr_url}{url}{last_sep}apikey={arr_api_key}"),
         )
-        .basic_auth(username, Some(password));
-    println!("{arr_url}{url}{last_sep}apikey={arr_api_key}");
+        .basic_auth(&credentials.username, Some(&credentials.password));
 
     if let Some(body_data) = data {
         request = request
@@ -7,7 +7,7 @@ use async_openai::types::{
     FunctionObjectArgs, Role,
 };
 use chrono::Local;
-use futures::Future;
+use futures::{future::OptionFuture, Future};
 use regex::Regex;
 use serde_json::json;
 use serenity::{
@@ -16,12 +16,37 @@ use serenity::{
     model::{channel::Message as DiscordMessage, gateway::Ready, user::CurrentUser},
     prelude::{Context as DiscordContext, EventHandler},
 };
-use std::{collections::HashMap, pin::Pin};
+use std::{
+    collections::{HashMap, VecDeque},
+    pin::Pin,
+    sync::{Arc, LazyLock, Mutex, OnceLock},
+};
 
-/// How long a thread of replies can be
+/// How many exchanges of a thread of replies are kept as history
 const MAX_THREAD_LIMIT: usize = 3;
 /// How many function calls can be made
 const MAX_FUNCTION_CALLS: usize = 4;
+/// How many characters of a function response are shown to the user
+const MAX_RESPONSE_PREVIEW_CHARS: usize = 150;
+/// Prefixes of thread history lines and who they are attributed to for the model
+const HISTORY_PREFIXES: [(&str, &str); 2] = [("💬 ", "User: "), ("☑️ ", "CineMatic: ")];
+/// Functions that only read data, safe to run alongside each other
+const READ_ONLY_FUNCTIONS: [&str; 5] = [
+    "media_lookup",
+    "media_query",
+    "media_wanted",
+    "media_downloads",
+    "web_search",
+];
+/// The bots own user, set once connected
+static BOT_USER: OnceLock<CurrentUser> = OnceLock::new();
+/// Per user locks, so a user can't have multiple messages processing at once
+static USER_LOCKS: LazyLock<Mutex<HashMap<UserId, Arc<tokio::sync::Mutex<()>>>>> =
+    LazyLock::new(|| Mutex::new(HashMap::new()));
+/// Matches user, role and channel mentions in message content
+static MENTION_REGEX: LazyLock<Regex> = LazyLock::new(|| Regex::new(r"<[@#]&?\d+>").unwrap());
+/// Static system prompt, kept identical between requests so it forms a cacheable prompt prefix
+const SYSTEM_PROMPT: &str = "You are media management assistant called CineMatic, enthusiastic, knowledgeable and passionate about all things media\nYou always run lookups to ensure correct id, do not rely on chat history, if the data you have received does not contain what you need you reply with the truthful answer of unknown, responses should all be on one line (with comma separation) and compact language, use emojis to express emotion to the user.";
 
 pub struct DiscordHandler;
 
@@ -29,15 +54,14 @@ pub struct DiscordHandler;
 impl EventHandler for DiscordHandler {
     async fn ready(&self, _: DiscordContext, ready: Ready) {
         println!("{} is connected!", ready.user.name);
+        BOT_USER.get_or_init(|| ready.user.clone());
     }
 
     async fn message(&self, ctx: DiscordContext, msg: DiscordMessage) {
-        if msg.author.bot
-            || get_bot_user(&ctx).await.unwrap().is_none()
-            || !should_process_message(&msg, cfg!(debug_assertions), &ctx)
-                .await
-                .unwrap()
-        {
+        let Some(bot_user) = BOT_USER.get() else {
+            return;
+        };
+        if msg.author.bot || !should_process_message(&msg, cfg!(debug_assertions), bot_user) {
             return;
         }
 
@@ -46,44 +70,50 @@ impl EventHandler for DiscordHandler {
             return;
         }
 
-        process_and_reply(
+        // Only process one message at a time per user
+        let user_lock = USER_LOCKS
+            .lock()
+            .unwrap()
+            .entry(msg.author.id)
+            .or_default()
+            .clone();
+        let user_guard = user_lock.lock().await;
+
+        let result = process_and_reply(
             user_text,
-            get_message_history(&msg, &get_bot_user(&ctx).await.unwrap().unwrap(), &ctx)
+            get_message_history(&msg, bot_user, &ctx)
                 .await
                 .unwrap()
                 .unwrap_or_default(),
             &msg,
             &ctx,
         )
-        .await
-        .expect("Failed to process and reply");
-    }
-}
+        .await;
+        drop(user_guard);
+
+        // Remove the users lock if only the map and this handler still hold it
+        {
+            let mut user_locks = USER_LOCKS.lock().unwrap();
+            if Arc::strong_count(&user_lock) == 2 {
+                user_locks.remove(&msg.author.id);
+            }
+        }
 
-async fn get_bot_user(ctx: &DiscordContext) -> anyhow::Result<Option<CurrentUser>> {
-    ctx.http
-        .get_current_user()
-        .await
-        .map(Some)
-        .context("Failed to get bot user")
+        result.expect("Failed to process and reply");
+    }
 }
 
-async fn should_process_message(
-    msg: &DiscordMessage,
-    is_debug: bool,
-    ctx: &DiscordContext,
-) -> anyhow::Result<bool> {
+fn should_process_message(msg: &DiscordMessage, is_debug: bool, bot_user: &CurrentUser) -> bool {
     let debug_valid = is_debug && msg.content.starts_with('!');
     let release_valid =
-        !is_debug && !msg.content.starts_with('!') && msg.mentions_me(&ctx.http).await?;
+        !is_debug && !msg.content.starts_with('!') && msg.mentions_user_id(bot_user.id);
 
-    Ok(debug_valid || release_valid)
+    debug_valid || release_valid
 }
 
 fn clean_user_text(msg: &DiscordMessage, is_debug: bool) -> String {
-    let regex = Regex::new(r"(?m)<[@#]&?\d+>").unwrap();
-    let mut user_text = msg.content.replace('\n', " ");
-    user_text = regex.replace_all(&user_text, "").trim().to_string();
+    let user_text = msg.content.replace('\n', " ");
+    let mut user_text = MENTION_REGEX.replace_all(&user_text, "").trim().to_string();
     if is_debug {
         user_text = user_text[1..].trim().to_string();
     }
@@ -101,17 +131,35 @@ async fn get_message_history(
             .message(&ctx.http, message_reference.message_id.unwrap())
             .await?;
 
-        let tick_count = replied_to.content.chars().filter(|&c| c == '☑').count();
-        if replied_to.author.id != bot_user.id
-            || !replied_to.content.contains('✅')
-            || tick_count > MAX_THREAD_LIMIT
-        {
+        if replied_to.author.id != bot_user.id || !replied_to.content.contains('✅') {
             return Ok(None);
         }
 
-        Ok(Some(
-            replied_to.content.replace("✅ ", "☑️ ").trim().to_string() + "\n",
-        ))
+        // Split the thread into exchanges, each starting with a users message, keeping only the latest
+        let mut exchanges: VecDeque<String> = VecDeque::with_capacity(MAX_THREAD_LIMIT + 1);
+        let mut exchange = String::new();
+        for line in replied_to.content.trim().lines() {
+            if line.starts_with('💬') && !exchange.is_empty() {
+                exchanges.push_back(std::mem::take(&mut exchange));
+                if exchanges.len() > MAX_THREAD_LIMIT {
+                    exchanges.pop_front();
+                }
+            }
+            // The previous final response becomes a past response
+            if let Some(response) = line.strip_prefix("✅ ") {
+                exchange.push_str("☑️ ");
+                exchange.push_str(response);
+            } else {
+                exchange.push_str(line);
+            }
+            exchange.push('\n');
+        }
+        exchanges.push_back(exchange);
+        if exchanges.len() > MAX_THREAD_LIMIT {
+            exchanges.pop_front();
+        }
+
+        Ok(Some(exchanges.into_iter().collect()))
     } else {
         Ok(None)
     }
@@ -126,13 +174,6 @@ async fn process_and_reply(
     // Collect user's ID and name
     let user_id = msg.author.id.to_string();
     let user_name = msg.author.name.clone();
-    let user_name_cleaned = apis::user_name_from_id(&user_id, &user_name)
-        .await
-        .context(format!("Failed to get user name from id: {user_id}"))?;
-    println!(
-        "Message from {} ({}): {}",
-        user_name_cleaned, user_id, msg.content
-    );
 
     // Choose a random reply message
     // let reply_messages: Vec<String> = serde_json::from_str(
@@ -146,11 +187,18 @@ async fn process_and_reply(
     let mention = assistant_id.mention();
     let reply_text = format!("Hey there, I am currently on leave for severe health issues (I've been diagnosed as a complete retard), I appreciate your message and have forwarded it on to my lovely assistant {mention} who will assist you ASAP");
 
-    // Send a reply message to the user
-    let _bot_message = msg
-        .reply(&ctx.http, format!("{message_history_text}⌛ {reply_text}"))
-        .await
-        .context("Failed to send message")?;
+    // Send a reply message to the user while getting their cleaned name
+    let (user_name_cleaned, bot_message) = tokio::join!(
+        apis::user_name_from_id(&user_id, &user_name),
+        msg.reply(&ctx.http, format!("{message_history_text}⌛ {reply_text}")),
+    );
+    let user_name_cleaned =
+        user_name_cleaned.context(format!("Failed to get user name from id: {user_id}"))?;
+    let _bot_message = bot_message.context("Failed to send message")?;
+    println!(
+        "Message from {} ({}): {}",
+        user_name_cleaned, user_id, msg.content
+    );
 
     // let ctx_clone = ctx.clone();
 
@@ -178,15 +226,11 @@ async fn process_chat(
     mut bot_message: DiscordMessage,
     message_history_text: String,
 ) -> anyhow::Result<()> {
-    // Get current date and time in DD/MM/YYYY and HH:MM:SS format
-    let date = Local::now().format("%d-%m-%Y").to_string();
-    let time = Local::now().format("%H:%M").to_string();
-
     let mut chat_query: Vec<ChatCompletionRequestMessage> = Vec::new();
     chat_query.push(create_chat_completion_request_message(
         Role::System,
         "Context",
-        &format!("You are media management assistant called CineMatic, enthusiastic, knowledgeable and passionate about all things media\nYou always run lookups to ensure correct id, do not rely on chat history, if the data you have received does not contain what you need you reply with the truthful answer of unknown, responses should all be on one line (with comma separation) and compact language, use emojis to express emotion to the user. The current date is {date}, the current time is {time}."),
+        SYSTEM_PROMPT,
     ));
 
     // If it contains a \n then it has history
@@ -196,13 +240,18 @@ async fn process_chat(
             "MessageHistory",
             &format!(
                 "Message history:\n{}",
-                message_history_text[..last_newline]
-                    .replace("💬 ", "User: ")
-                    .replace("☑️ ", "CineMatic: ")
+                history_to_prompt(&message_history_text[..last_newline])
             ),
         ));
     }
 
+    // Add the date and time after the history so the prompt prefix stays the same over a thread
+    chat_query.push(create_chat_completion_request_message(
+        Role::System,
+        "DateTime",
+        &date_time_message(),
+    ));
+
     // Add users message
     chat_query.push(create_chat_completion_request_message(
         Role::User,
@@ -217,84 +266,129 @@ async fn process_chat(
     // Add users message to extra_history_text
     extra_history_text.push_str(format!("💬 {user_name}: {users_text}\n",).as_str());
 
-    for func_n in 0..MAX_FUNCTION_CALLS {
-        let chat_tools = get_functions()
-            .iter()
-            .map(func_to_chat_tool)
-            .collect::<Vec<_>>();
+    let chat_tools = get_functions()
+        .iter()
+        .map(func_to_chat_tool)
+        .collect::<Vec<_>>();
 
+    for func_n in 0..MAX_FUNCTION_CALLS {
         let tool_choice = if func_n == MAX_FUNCTION_CALLS - 1 {
             ChatCompletionToolChoiceOption::None
         } else {
             ChatCompletionToolChoiceOption::Auto
         };
 
-        let response_message = async_openai::Client::new()
-            .chat()
-            .create(
-                CreateChatCompletionRequestArgs::default()
-                    .model("gpt-4o")
-                    .messages(chat_query.clone())
-                    .tools(chat_tools)
-                    .tool_choice(tool_choice)
-                    .build()?,
-            )
-            .await?
-            .choices
-            .first()
-            .unwrap()
-            .message
-            .clone();
+        let request = CreateChatCompletionRequestArgs::default()
+            .model("gpt-4o")
+            .messages(chat_query.clone())
+            .tools(chat_tools.clone())
+            .tool_choice(tool_choice)
+            .build()?;
+        let response = {
+            let _permit = apis::OPENAI_PERMITS.acquire().await?;
+            apis::OPENAI_CLIENT.chat().create(request).await?
+        };
+
+        // Log how much of the prompt was served from openai's prompt cache
+        if let Some(usage) = &response.usage {
+            let cached_tokens = usage
+                .prompt_tokens_details
+                .as_ref()
+                .and_then(|details| details.cached_tokens)
+                .unwrap_or(0);
+            println!(
+                "Chat completion prompt tokens: {} ({cached_tokens} cached)",
+                usage.prompt_tokens
+            );
+        }
+
+        let response_message = response.choices.first().unwrap().message.clone();
 
         if let Some(tool_calls) = response_message.tool_calls {
+            let mut function_calls = Vec::new();
             for tool_call in tool_calls {
-                let function_name = tool_call.function.name;
                 let function_args: serde_json::Value = tool_call.function.arguments.parse()?;
+                function_calls.push((tool_call.function.name, function_args));
+            }
+
+            // Edit the discord message with function calls in progress
+            let running_text = function_calls
+                .iter()
+                .map(|(function_name, function_args)| {
+                    format!("⌛ Running function {function_name} with arguments {function_args}")
+                })
+                .collect::<Vec<_>>()
+                .join("\n");
+            edit_bot_message(
+                &ctx,
+                &mut bot_message,
+                format!("{message_history_text}{extra_history_text}{running_text}"),
+            )
+            .await?;
 
-                // Edit the discord message with function call in progress
-                edit_bot_message(
-                    &ctx,
-                    &mut bot_message,
-                    format!("{message_history_text}{extra_history_text}⌛ Running function {function_name} with arguments {function_args}"),
-                )
-                .await?;
+            // Run the read only function calls in parallel
+            let read_only_responses = futures::future::join_all(function_calls.iter().map(
+                |(function_name, function_args)| {
+                    OptionFuture::from(
+                        READ_ONLY_FUNCTIONS
+                            .contains(&function_name.as_str())
+                            .then(|| {
+                                run_function(function_name.clone(), function_args, &user_name)
+                            }),
+                    )
+                },
+            ))
+            .await;
+
+            // Then run the ones that change the servers one at a time, in call order
+            let mut function_responses = Vec::new();
+            for ((function_name, function_args), read_only_response) in
+                function_calls.iter().zip(read_only_responses)
+            {
+                let function_response = match read_only_response {
+                    Some(function_response) => function_response,
+                    None => run_function(function_name.clone(), function_args, &user_name).await,
+                };
+                function_responses.push(function_response);
+            }
 
+            for ((function_name, _), function_response) in
+                function_calls.iter().zip(function_responses)
+            {
                 // Get function response as string if either ok or error
-                let function_response =
-                    run_function(function_name.clone(), &function_args, &user_name).await;
                 let function_response_message = function_response.unwrap_or_else(|e| e.to_string());
 
-                // Truncate the function response to 100 characters
-                let function_response_short = if function_response_message.len() > 150 {
-                    let trimmed_message = function_response_message
-                        .chars()
-                        .take(150)
-                        .collect::<String>();
-                    format!("{trimmed_message}...")
-                } else {
-                    function_response_message.clone()
-                };
+                // Truncate the function response for display
+                let function_response_short =
+                    if function_response_message.chars().count() > MAX_RESPONSE_PREVIEW_CHARS {
+                        let trimmed_message = function_response_message
+                            .chars()
+                            .take(MAX_RESPONSE_PREVIEW_CHARS)
+                            .collect::<String>();
+                        format!("{trimmed_message}...")
+                    } else {
+                        function_response_message.clone()
+                    };
 
-                // Edit the discord message with function call results
                 extra_history_text.push_str(
                     format!("🎬 Ran function {function_name} {function_response_short}\n",)
                         .as_str(),
                 );
-                edit_bot_message(
-                    &ctx,
-                    &mut bot_message,
-                    format!("{message_history_text}{extra_history_text}"),
-                )
-                .await?;
 
                 chat_query.push(create_chat_completion_request_message(
                     Role::System,
                     "tool_response",
-                    &format!(
-                        "Function {function_response_message} returned {function_response_message}"
-                    ),
+                    &format!("Function {function_name} returned {function_response_message}"),
                 ));
             }
+
+            // Edit the discord message with function call results
+            edit_bot_message(
+                &ctx,
+                &mut bot_message,
+                format!("{message_history_text}{extra_history_text}"),
+            )
+            .await?;
         } else {
             final_response = response_message.content.unwrap();
             break;
@@ -312,6 +406,31 @@ async fn process_chat(
     Ok(())
 }
 
+/// Convert thread history lines into plain text for the model, in a single pass
+fn history_to_prompt(history: &str) -> String {
+    history
+        .lines()
+        .map(|line| {
+            HISTORY_PREFIXES
+                .iter()
+                .find_map(|(prefix, speaker)| {
+                    line.strip_prefix(prefix)
+                        .map(|text| format!("{speaker}{text}"))
+                })
+                .unwrap_or_else(|| line.to_string())
+        })
+        .collect::<Vec<_>>()
+        .join("\n")
+}
+
+/// Get the current date and time message, to the minute
+fn date_time_message() -> String {
+    // Get current date and time in DD-MM-YYYY and HH:MM format
+    Local::now()
+        .format("The current date is %d-%m-%Y, the current time is %H:%M.")
+        .to_string()
+}
+
 // Helper function for editing bot messages
 async fn edit_bot_message(
     ctx: &DiscordContext,
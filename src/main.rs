@@ -14,6 +14,8 @@ mod plugins;
 #[tokio::main]
 async fn main() {
     dotenvy::dotenv().ok();
+    // Fail fast on missing sonarr or radarr settings, rather than on the first request
+    apis::ArrService::load_credentials();
 
     let mut client: DiscordClient = DiscordClient::builder(
         apis::get_env_variable("DISCORD_TOKEN"),
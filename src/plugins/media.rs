@@ -5,7 +5,16 @@ use crate::{
 use anyhow::anyhow;
 use futures::Future;
 use serde_json::Value;
-use std::{collections::HashMap, pin::Pin};
+use std::{
+    collections::{HashMap, HashSet},
+    pin::Pin,
+    sync::LazyLock,
+    time::Duration,
+};
+
+/// Recent lookup results, keyed by format and lowercased search term
+static LOOKUP_CACHE: LazyLock<apis::TimedCache<Value>> =
+    LazyLock::new(|| apis::TimedCache::new(Duration::from_secs(10 * 60), 2048));
 
 #[derive(Debug, Clone)]
 enum Format {
@@ -198,23 +207,19 @@ async fn query_server(
 
 /// Perform a lookup of movies with ai processing to answer a prompt
 async fn lookup(media_type: Format, searches: String, query: String) -> anyhow::Result<String> {
-    let terms: Vec<String> = searches.split('|').map(|s| s.trim().to_string()).collect();
+    // Get unique search terms, ignoring case the same way as the lookup cache
+    let mut terms: Vec<String> = Vec::new();
+    let mut seen_terms = HashSet::new();
+    for term in searches.split('|').map(str::trim) {
+        if !term.is_empty() && seen_terms.insert(term.to_lowercase()) {
+            terms.push(term.to_string());
+        }
+    }
 
     // Get list of searches per term
-    let mut arr_searches = vec![];
-    let service = match media_type {
-        Format::Movie => apis::ArrService::Radarr,
-        Format::Series => apis::ArrService::Sonarr,
-    };
-    for term in &terms {
-        let cleaned_term = term.replace(' ', "%20");
-        arr_searches.push(apis::arr_request(
-            reqwest::Method::GET,
-            service.clone(),
-            format!("/api/v3/{media_type}/lookup?term={cleaned_term}"),
-            None,
-        ));
-    }
+    let arr_searches = terms
+        .iter()
+        .map(|term| lookup_term(media_type.clone(), term.clone()));
 
     // Wait for all searches to finish parallel
     let arr_searches: Vec<Result<Value, anyhow::Error>> =
@@ -240,6 +245,32 @@ async fn lookup(media_type: Format, searches: String, query: String) -> anyhow::
     query_with_gpt(media_strings.join("\n"), query).await
 }
 
+/// Search sonarr or radarr for a term, reusing recent results
+async fn lookup_term(media_type: Format, term: String) -> anyhow::Result<Value> {
+    let cache_key = format!("{media_type}|{}", term.to_lowercase());
+    if let Some(cached) = LOOKUP_CACHE.get(&cache_key) {
+        return Ok(cached);
+    }
+    // Only store the result if no media was added or changed while the request was in flight
+    let generation = LOOKUP_CACHE.generation();
+
+    let service = match media_type {
+        Format::Movie => apis::ArrService::Radarr,
+        Format::Series => apis::ArrService::Sonarr,
+    };
+    let cleaned_term = term.replace(' ', "%20");
+    let search = apis::arr_request(
+        reqwest::Method::GET,
+        service,
+        format!("/api/v3/{media_type}/lookup?term={cleaned_term}"),
+        None,
+    )
+    .await?;
+
+    LOOKUP_CACHE.insert_if_current(generation, cache_key, search.clone());
+    Ok(search)
+}
+
 /// Add media to the server
 async fn add(
     media_type: Format,
@@ -335,6 +366,8 @@ async fn add(
     apis::arr_request(reqwest::Method::POST, service, endpoint, Some(media))
         .await
         .map_err(|e| anyhow!("Failed to add media: {e}"))?;
+    // Lookups cached before the add would show it as unavailable
+    LOOKUP_CACHE.clear();
 
     Ok(format!(
         "Added {media_type} with tmdbId/tvdbId {db_id} in {quality}"
@@ -401,8 +434,11 @@ async fn push(media_type: Format, media_json: Value) -> anyhow::Result<()> {
 
     apis::arr_request(reqwest::Method::PUT, service, path, Some(media))
         .await
-        .map_err(|e| anyhow!("Failed to push media: {e}"))
-        .map(|_| ())
+        .map_err(|e| anyhow!("Failed to push media: {e}"))?;
+
+    // Lookups cached before the change would be out of date
+    LOOKUP_CACHE.clear();
+    Ok(())
 }
 
 /// Remove wanted tag from media for user
@@ -425,8 +461,8 @@ async fn remove(media_type: Format, id: String, user_name: &str) -> anyhow::Resu
     let tag_id = get_user_tag_id(media_type.clone(), user_name).await?;
 
     // Check if media is already on the server
-    if let Value::Number(id) = &media["id"] {
-        if id.as_u64().unwrap() != 0 {
+    if let Some(server_id) = media["id"].as_u64() {
+        if server_id != 0 {
             // If already has the tag that user wants it, remove the tag for the user and return
             if media["tags"].as_array().unwrap().contains(&tag_id.into()) {
                 let mut new_media = media.clone();
@@ -440,11 +476,11 @@ async fn remove(media_type: Format, id: String, user_name: &str) -> anyhow::Resu
                 new_media["tags"] = new_tags.into();
                 push(media_type.clone(), new_media).await?;
                 return Ok(format!(
-                    "{media_type} with id {id} has been unrequested for user"
+                    "{media_type} with id {server_id} has been unrequested for user"
                 ));
             }
             return Err(anyhow!(
-                "Couldn't remove {media_type} with id {id}, user hasn't requested it"
+                "Couldn't remove {media_type} with id {server_id}, user hasn't requested it"
             ));
         }
     };
@@ -510,7 +546,7 @@ async fn check_downloads() -> anyhow::Result<String> {
             .ok_or_else(|| anyhow!("Expected an array of downloads"))?;
 
         let mut downloads_info = Vec::new();
-        let mut seen_titles = std::collections::HashSet::new();
+        let mut seen_titles = HashSet::new();
 
         for download in downloads {
             let title = download["title"].as_str().unwrap_or("Unknown Title");
@@ -592,7 +628,8 @@ async fn get_user_tag_id(media_type: Format, user_name: &str) -> anyhow::Result<
 /// Sync tags on sonarr or radarr for added-username
 async fn sync_user_tags(media_type: Format) -> anyhow::Result<()> {
     // Read and parse the TOML file
-    let parsed_toml: toml::Value = std::fs::read_to_string("names.toml")
+    let parsed_toml: toml::Value = tokio::fs::read_to_string("names.toml")
+        .await
         .map_err(|e| anyhow!("Failed to read names.toml {e}"))?
         .parse()?;
 
@@ -703,7 +740,6 @@ async fn get_media_with_user_tag(
     };
 
     // Get user tag id
-    println!("Getting user tag id {} {}", media_type.clone(), user_name);
     let tag_id = get_user_tag_id(media_type.clone(), user_name)
         .await?
         .ok_or_else(|| anyhow!("No tag id found for user: '{}'", user_name))?;
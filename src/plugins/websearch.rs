@@ -5,11 +5,34 @@ use crate::{
 use anyhow::anyhow;
 use futures::Future;
 use regex::Regex;
-use reqwest;
 use scraper::{Html, Selector};
 use serde::Serialize;
 use serde_json;
-use std::{collections::HashMap, pin::Pin};
+use std::{collections::HashMap, pin::Pin, sync::LazyLock, time::Duration};
+
+/// Most characters of a wikipedia article to include in the search results
+const MAX_WIKI_CHARS: usize = 4000;
+/// Most characters of search results to send to gpt
+const MAX_BLOB_CHARS: usize = 8192;
+
+/// Answers to recent searches, keyed by normalised query
+static SEARCH_CACHE: LazyLock<apis::TimedCache<String>> =
+    LazyLock::new(|| apis::TimedCache::new(Duration::from_secs(60 * 60), 1024));
+
+/// Matches html tags in the summarizer text
+static HTML_TAG_REGEX: LazyLock<Regex> = LazyLock::new(|| Regex::new(r"<[^>]*>").unwrap());
+
+/// Selectors for scraping brave search results
+static RESULT_SELECTOR: LazyLock<Selector> = LazyLock::new(|| Selector::parse(".snippet").unwrap());
+static TITLE_SELECTOR: LazyLock<Selector> = LazyLock::new(|| Selector::parse(".title").unwrap());
+static LINK_SELECTOR: LazyLock<Selector> = LazyLock::new(|| Selector::parse(".h").unwrap());
+static SNIPPET_SELECTOR: LazyLock<Selector> = LazyLock::new(|| {
+    Selector::parse(".snippet-content .snippet-description , .snippet-description:nth-child(1)")
+        .unwrap()
+});
+static RATING_SELECTOR: LazyLock<Selector> = LazyLock::new(|| Selector::parse(".ml-10").unwrap());
+/// Selects paragraphs of a wikipedia article
+static PARAGRAPH_SELECTOR: LazyLock<Selector> = LazyLock::new(|| Selector::parse("p").unwrap());
 
 #[derive(Serialize, Debug)]
 struct SearchResultBrave {
@@ -43,16 +66,21 @@ pub fn get_functions() -> Vec<Func> {
 }
 
 async fn brave(query: String) -> anyhow::Result<SearchBrave> {
-    let response_search = reqwest::get(format!("https://search.brave.com/search?q={query}")).await;
+    let response_search = apis::HTTP_CLIENT
+        .get(format!("https://search.brave.com/search?q={query}"))
+        .send()
+        .await;
     if response_search.is_err() {
         return Err(anyhow!("Failed to fetch brave search"));
     }
 
     // Get the summarizer text if exists
-    let response_summary = reqwest::get(format!(
-        "https://search.brave.com/api/summarizer?key={query}:us:en"
-    ))
-    .await;
+    let response_summary = apis::HTTP_CLIENT
+        .get(format!(
+            "https://search.brave.com/api/summarizer?key={query}:us:en"
+        ))
+        .send()
+        .await;
 
     let mut summary: Option<String> = None;
     if response_summary.is_ok() {
@@ -62,8 +90,7 @@ async fn brave(query: String) -> anyhow::Result<SearchBrave> {
         // If json has ["results"][0]["text"] then use that as the summary
         if !json["results"][0]["text"].is_null() {
             let text = json["results"][0]["text"].as_str().unwrap_or("No summary");
-            let regex = Regex::new(r"<[^>]*>").unwrap();
-            summary = Some(regex.replace_all(text, "").to_string());
+            summary = Some(HTML_TAG_REGEX.replace_all(text, "").to_string());
         }
     }
 
@@ -72,10 +99,10 @@ async fn brave(query: String) -> anyhow::Result<SearchBrave> {
     let document = Html::parse_document(&html_text);
 
     let brave_organic_search_results: Vec<SearchResultBrave> = document
-        .select(&Selector::parse(".snippet").unwrap())
+        .select(&RESULT_SELECTOR)
         .filter_map(|element| {
             let title = element
-                .select(&Selector::parse(".title").unwrap())
+                .select(&TITLE_SELECTOR)
                 .next()?
                 .text()
                 .collect::<String>()
@@ -87,19 +114,14 @@ async fn brave(query: String) -> anyhow::Result<SearchBrave> {
             }
 
             let link = element
-                .select(&Selector::parse(".h").unwrap())
+                .select(&LINK_SELECTOR)
                 .next()?
                 .value()
                 .attr("href")?
                 .to_string();
 
             let raw_snippet = element
-                .select(
-                    &Selector::parse(
-                        ".snippet-content .snippet-description , .snippet-description:nth-child(1)",
-                    )
-                    .unwrap(),
-                )
+                .select(&SNIPPET_SELECTOR)
                 .next()?
                 .text()
                 .collect::<String>()
@@ -115,7 +137,7 @@ async fn brave(query: String) -> anyhow::Result<SearchBrave> {
             );
 
             let rating = element
-                .select(&Selector::parse(".ml-10").unwrap())
+                .select(&RATING_SELECTOR)
                 .next()
                 .map(|el| el.text().collect::<String>())
                 .unwrap_or_default()
@@ -142,6 +164,16 @@ async fn brave(query: String) -> anyhow::Result<SearchBrave> {
 
 /// Perform a search with ai processing to answer a prompt
 async fn ai_search(query: String) -> anyhow::Result<String> {
+    // Reuse the answer if the same query was searched recently
+    let cache_key = query
+        .split_whitespace()
+        .collect::<Vec<_>>()
+        .join(" ")
+        .to_lowercase();
+    if let Some(answer) = SEARCH_CACHE.get(&cache_key) {
+        return Ok(answer);
+    }
+
     // Get the search results
     let mut search_results: SearchBrave = brave(query.clone()).await.unwrap();
     if search_results.results.is_empty() {
@@ -156,14 +188,13 @@ async fn ai_search(query: String) -> anyhow::Result<String> {
                 "https://en.wikipedia.org/api/rest_v1/page/html/{}",
                 result.link.split('/').last().unwrap()
             );
-            let response = reqwest::get(new_link).await;
+            let response = apis::HTTP_CLIENT.get(new_link).send().await;
             if response.is_ok() {
                 let body = response.unwrap().text().await.unwrap();
                 // Scrape the html, only include paragraphs
                 let document = Html::parse_document(&body);
-                let selector = Selector::parse("p").unwrap();
                 let mut text = document
-                    .select(&selector)
+                    .select(&PARAGRAPH_SELECTOR)
                     .map(|element| element.text().collect::<String>())
                     .collect::<Vec<String>>()
                     .join("\n");
@@ -176,7 +207,7 @@ async fn ai_search(query: String) -> anyhow::Result<String> {
                 text = text.replace("\n\n", " ");
 
                 // Limit the text characters
-                text = text.chars().take(4000).collect::<String>();
+                text = text.chars().take(MAX_WIKI_CHARS).collect::<String>();
                 // Replace the snippet with the new text
                 search_results.results[index].snippet = text;
             }
@@ -186,17 +217,22 @@ async fn ai_search(query: String) -> anyhow::Result<String> {
     }
 
     // Create a blob of text to send to the ai with all site data, with max character limit
-    let mut blob = String::new();
-    blob += &format!("Summary: {}\n", search_results.summary);
+    let mut blob = format!("Summary: {}\n", search_results.summary);
+    let mut blob_chars = blob.chars().count();
     for (index, result) in search_results.results.iter().enumerate() {
-        blob += &format!(
+        let line = format!(
             "[{}] {} ({}): {} {}\n",
             index, result.link, result.published, result.snippet, result.rating
         );
-        // If the blob is too large, stop adding to it
-        if blob.len() > 8192 {
+        // If the line would take the blob over the limit, fill the rest of the limit with it and stop
+        let line_chars = line.chars().count();
+        let remaining_chars = MAX_BLOB_CHARS.saturating_sub(blob_chars);
+        if line_chars > remaining_chars {
+            blob.extend(line.chars().take(remaining_chars));
             break;
         }
+        blob_chars += line_chars;
+        blob += &line;
     }
 
     // Search with gpt through the blob to answer the query
@@ -205,5 +241,7 @@ async fn ai_search(query: String) -> anyhow::Result<String> {
     if response.is_err() {
         return Err(anyhow!("Couldn't find an answer"));
     }
-    Ok(response.unwrap().replace('\n', " "))
+    let answer = response.unwrap().replace('\n', " ");
+    SEARCH_CACHE.insert(cache_key, answer.clone());
+    Ok(answer)
 }